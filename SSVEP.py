@@ -1,11 +1,8 @@
 import sys
-import random
-import csv
 import os
 import numpy as np
 import time
-import json
-from enum import Enum
+from enum import Enum, IntEnum
 
 from pydantic import BaseModel, Field
 from typing import Annotated
@@ -14,8 +11,8 @@ from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QLabel, QPushButton, 
     QVBoxLayout, QSpinBox, QLineEdit, QFileDialog
 )
-from PyQt5.QtCore import QTimer, Qt, QEventLoop, QElapsedTimer
-from PyQt5.QtGui import QColor, QPalette
+from PyQt5.QtCore import QTimer, Qt, QElapsedTimer
+from PyQt5.QtGui import QBrush, QColor, QPainter, QPalette
 
 
 class Config(BaseModel):
@@ -35,71 +32,86 @@ class State(Enum):
     COOLDOWN = 'cooldown'
     STOPPED = 'stopped'
 
+class Color(IntEnum):
+    # Indices into FlashingWidget's brush table, after the 0-255 grayscale levels.
+    # CLEAR paints the window background color, since the widget paints opaquely.
+    CLEAR = 256
+    RED = 257
+
+def _frozen(values, dtype=None):
+    array = np.array(values, dtype=dtype)
+    array.setflags(write=False)
+    return array
+
+_CENTERS = {
+    1: _frozen([[1/2, 1/2]]),
+    2: _frozen([[1/3 - 0.1, 1/2],[2/3 + 0.1, 1/2]]),
+    3: _frozen([[1/4 - 0.1, 1/2],[1/2, 1/2],[3/4 + 0.1, 1/2]]),
+    4: _frozen([[1/3 - 0.1, 1/3 - 0.1],[2/3 + 0.1, 1/3 - 0.1],[1/3 - 0.1, 2/3 + 0.1], [2/3 + 0.1, 2/3 + 0.1]]),
+    5: _frozen([[1/3 - 0.1, 1/3 - 0.1],[2/3 + 0.1, 1/3 - 0.1],[1/4 - 0.1, 2/3 + 0.1], [1/2, 2/3 + 0.1], [3/4 + 0.1, 2/3 + 0.1]]),
+    6: _frozen([[1/4 - 0.1, 1/3 - 0.1],[1/2, 1/3 - 0.1], [3/4 + 0.1, 1/3 - 0.1], [1/4 - 0.1, 2/3 + 0.1], [1/2, 2/3 + 0.1], [3/4 + 0.1, 2/3 + 0.1]]),
+}
+
+_FREQS = {
+    1: _frozen([11], dtype=np.float32),
+    2: _frozen([5, 15], dtype=np.float32),
+    3: _frozen([5, 10, 15], dtype=np.float32),
+    4: _frozen([5, 8, 12, 15], dtype=np.float32),
+    5: _frozen([5, 7.5, 10, 12.5, 15], dtype=np.float32),
+    6: _frozen([5, 7, 9, 11, 13, 15], dtype=np.float32),
+}
+
 def get_widget_centers(num_classes):
-    if num_classes == 1:
-        return np.array([[1/2, 1/2]])
-    elif num_classes == 2:
-        return np.array([[1/3 - 0.1, 1/2],[2/3 + 0.1, 1/2]])
-    elif num_classes == 3:
-        return np.array([[1/4 - 0.1, 1/2],[1/2, 1/2],[3/4 + 0.1, 1/2]])
-    elif num_classes == 4:
-        return np.array([[1/3 - 0.1, 1/3 - 0.1],[2/3 + 0.1, 1/3 - 0.1],[1/3 - 0.1, 2/3 + 0.1], [2/3 + 0.1, 2/3 + 0.1]])
-    elif num_classes == 5:
-        return np.array([[1/3 - 0.1, 1/3 - 0.1],[2/3 + 0.1, 1/3 - 0.1],[1/4 - 0.1, 2/3 + 0.1], [1/2, 2/3 + 0.1], [3/4 + 0.1, 2/3 + 0.1]])
-    else:
-        return np.array([[1/4 - 0.1, 1/3 - 0.1],[1/2, 1/3 - 0.1], [3/4 + 0.1, 1/3 - 0.1], [1/4 - 0.1, 2/3 + 0.1], [1/2, 2/3 + 0.1], [3/4 + 0.1, 2/3 + 0.1]])
-    
-def get_flashing_frequencies(num_classes):
-    if num_classes == 1:
-        output = np.array([11])
-    elif num_classes == 2:
-        output = np.array([5, 15])
-    elif num_classes == 3:
-        output = np.array([5, 10, 15])
-    elif num_classes == 4:
-        output = np.array([5, 8, 12, 15])
-    elif num_classes == 5:
-        output = np.array([5, 7.5, 10, 12.5, 15])
-    else:
-        output = np.array([5, 7, 9, 11, 13, 15])
-    np.random.shuffle(output)
-    return output
+    return _CENTERS[num_classes]
+
+def get_flashing_frequencies(num_classes, rng):
+    return rng.permutation(_FREQS[num_classes])
+
+# Sinusoidal luminance S(f, i) = 0.5 * (1 + sin(2*pi*f*i/refresh_rate)) as 0-255 gray levels, one column per frequency
+def build_schedule(frequencies, num_frames, refresh_rate):
+    frames = np.arange(num_frames, dtype=np.float32)
+    return (0.5 * (1 + np.sin(2 * np.pi * frequencies[None, :] * frames[:, None] / refresh_rate)) * 255).astype(np.uint8)
 
 class FlashingWidget(QWidget):
+    _brushes: list[QBrush] = []
+
     def __init__(self, frequency):
         super().__init__()
-        self.elapsed_timer = QElapsedTimer()
-        self.elapsed_timer.start()
-
         self.frequency = frequency
-        self.is_white = False
-        self.toggle_interval = int(1000 / (self.frequency * 2))
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.toggle_flash)
-
-        self.setAutoFillBackground(True)
-        self.update_color(QColor(0, 0, 0, 0))
 
-    def start_flashing(self):
-        self.timer.start(self.toggle_interval)
+        # One brush per grayscale level plus clear/red; paintEvent just fills with the current one.
+        # Brushes are never mutated, so the table is built once and shared by every widget.
+        # The widget paints opaquely, so "clear" is drawn in the window background color rather than transparent.
+        if not FlashingWidget._brushes:
+            background = QApplication.palette().color(QPalette.ColorRole.Window)
+            colors = [QColor(level, level, level) for level in range(256)] + [background, QColor(255, 0, 0)]
+            FlashingWidget._brushes = [QBrush(color) for color in colors]
+        self._brush = self._brushes[Color.CLEAR]
+        self._current_color_id = Color.CLEAR
+
+        # paintEvent covers the whole rect, so skip Qt's background erase and style sheet painting
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent, True)
+        self.setAttribute(Qt.WidgetAttribute.WA_NoSystemBackground, True)
+        self.setAttribute(Qt.WidgetAttribute.WA_StyledBackground, False)
+        self.setAttribute(Qt.WidgetAttribute.WA_PaintOnScreen, False)
+        self.setUpdatesEnabled(True)
 
     def stop_flashing(self):
-        self.timer.stop()
-        self.update_color(QColor(0, 0, 0, 0))
+        self.update_color(Color.CLEAR)
 
-    def toggle_flash(self):
-        self.is_white = not self.is_white
-        self.update_color()
+    def update_color(self, color: Color):
+        # Skip same-color writes so unchanged frames don't schedule a repaint
+        if color == self._current_color_id:
+            return
+        self._current_color_id = color
+        self._brush = self._brushes[color]
+        self.update()
 
-    def update_color(self, color=None):
-        color = color or (QColor("white") if self.is_white else QColor("black"))
-        palette = self.palette()
-        palette.setColor(QPalette.ColorRole.Window, color)
-        self.setPalette(palette)
+    def paintEvent(self, event):
+        QPainter(self).fillRect(self.rect(), self._brush)
 
     def update_frequency(self, new_frequency):
         self.frequency = new_frequency
-        self.toggle_interval = int(1000 / (self.frequency * 2))
 
 class ConfigWindow(QMainWindow):
     def __init__(self):
@@ -207,35 +219,66 @@ class ExperimentWindow(QMainWindow):
         super().__init__()
         self.config = config
         self.flashing_widgets: list[FlashingWidget] = []
+        self._freq_to_widget: dict[float, FlashingWidget] = {}
         self.current_iteration = 0
+        self.target_widget = None
+        total_trials = self.config.num_classes * self.config.num_sessions
+        self._progress = [f"{round(i * 100 / total_trials)} %" for i in range(total_trials + 1)]
         self.countdown_label_text = f'Progress: {self.get_progress(self.current_iteration)}\nStarting In: '
-        self.frequencies = np.random.permutation(np.repeat(get_flashing_frequencies(self.config.num_classes), self.config.num_sessions))
+        self._rng = np.random.default_rng()
+        self._trial_schedule = self._rng.permutation(np.tile(_FREQS[self.config.num_classes], self.config.num_sessions)).tolist()
 
         os.makedirs(self.config.experiment_path, exist_ok=True)
         self.file_name = os.path.join(self.config.experiment_path, 'state.csv')
         self.config_file_name = os.path.join(self.config.experiment_path, 'config.json')
         
-        with open(self.file_name, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["timestamp", "iteration",  "state", "notes"])
+        # Keep the state log open for the whole experiment; closed in stop_experiment
+        self._log_fd = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        os.write(self._log_fd, b"timestamp,iteration,state,notes\r\n")
 
         self.setup_UI()
+
+        # Single frame-synced timer drives every flashing widget
+        self.refresh_rate = QApplication.primaryScreen().refreshRate()
+        self._frame_period_us = 1_000_000 / self.refresh_rate
+        # The frequency set is fixed for the experiment, so build its phase table once and pick columns per trial
+        self._phase_table = build_schedule(_FREQS[self.config.num_classes], int(self.refresh_rate * self.config.flashing_duration), self.refresh_rate)
+        self._freq_columns = {float(frequency): j for j, frequency in enumerate(_FREQS[self.config.num_classes])}
+        self.schedule = None
+        self.frame_idx = 0
+        self.elapsed_timer = QElapsedTimer()
+        self.master_timer = QTimer(self)
+        self.master_timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.master_timer.setSingleShot(True)
+        self.master_timer.timeout.connect(self._tick)
+
+        self._count_prefix = None
+        self._count_strings = []
+        self._countdown_cb = None
+        self._countdown_value = 0
+        self.countdown_timer = QTimer(self)
+        self.countdown_timer.timeout.connect(self._on_countdown_tick)
+
         self.set_state(State.COUNTDOWN)
-        self.show_countdown(self.config.trial_start_countdown, self.start_trial)
+        self.show_countdown(self.config.trial_start_countdown, self._trial_show_target)
         self.dump_config_to_json()
 
     def dump_config_to_json(self):
         try:
             with open(self.config_file_name, mode='w', newline='') as config_file:
-                config_file.write(json.dumps(self.config.dict(), indent=4))
+                # Pydantic v2 exposes model_dump_json; v1 only has .json()
+                if hasattr(self.config, 'model_dump_json'):
+                    config_file.write(self.config.model_dump_json(indent=4))
+                else:
+                    config_file.write(self.config.json(indent=4))
         except Exception as e:
             print(f"Error dumping config to JSON: {e}")
 
     def log_state(self, notes: str):
-        timestamp = str(time.time())
-        with open(self.file_name, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([timestamp, self.current_iteration if self.current_state != State.COOLDOWN else (self.current_iteration - 1), self.current_state.value, notes])
+        # Fixed schema, so format the row directly; notes are plain identifiers and only need comma escaping
+        iteration = self.current_iteration if self.current_state != State.COOLDOWN else (self.current_iteration - 1)
+        row = f"{time.time():.6f},{iteration},{self.current_state.value},{notes.replace(',', ';')}\r\n"
+        os.write(self._log_fd, row.encode())
 
     def setup_UI(self):
         self.setWindowTitle("NeuroPawn SSVEP")
@@ -268,13 +311,7 @@ class ExperimentWindow(QMainWindow):
         self.render_flashing_widgets()
 
     def get_progress(self, iteration):
-        return f"{round(iteration * 100 / (self.config.num_classes * self.config.num_sessions))} %"
-    
-    def get_random_frequency(self):
-        selected_frequency = random.choice(self.frequencies)
-        indices = np.where(self.frequencies == selected_frequency)[0]
-        self.frequencies = np.delete(self.frequencies, indices[0])
-        return selected_frequency
+        return self._progress[iteration]
     
     def render_flashing_widgets(self):
         for widget in self.flashing_widgets:
@@ -283,7 +320,11 @@ class ExperimentWindow(QMainWindow):
         self.flashing_widgets = []
 
         widget_coords_normalized = get_widget_centers(self.config.num_classes)
-        frequencies = get_flashing_frequencies(self.config.num_classes)
+        frequencies = get_flashing_frequencies(self.config.num_classes, self._rng)
+
+        stimuli_size = np.array([[self.config.stimuli_size * 1.5, self.config.stimuli_size]])
+        area_size = np.array([[self.flashing_area.width(), self.flashing_area.height()]])
+        widget_coords = (widget_coords_normalized * area_size - stimuli_size / 2).astype(np.int32)
 
         for i in range(self.config.num_classes):
             frequency = frequencies[i]
@@ -291,77 +332,104 @@ class ExperimentWindow(QMainWindow):
             widget.setFixedSize(int(self.config.stimuli_size*1.5), self.config.stimuli_size)
 
             widget.setParent(self.flashing_area)
-            widget.move(int(self.flashing_area.width() * widget_coords_normalized[i, 0] - self.config.stimuli_size *1.5 / 2), int(self.flashing_area.height() * widget_coords_normalized[i, 1] - self.config.stimuli_size / 2))
+            widget.move(int(widget_coords[i, 0]), int(widget_coords[i, 1]))
             widget.show()
 
             self.flashing_widgets.append(widget)
+
+        self._freq_to_widget = {float(widget.frequency): widget for widget in self.flashing_widgets}
     
     def shuffle_frequencies(self):
-        new_frequencies = get_flashing_frequencies(self.config.num_classes)
+        new_frequencies = get_flashing_frequencies(self.config.num_classes, self._rng)
         for i , new_frequency in enumerate(new_frequencies):
             self.flashing_widgets[i].update_frequency(new_frequency)
+        self._freq_to_widget = {float(widget.frequency): widget for widget in self.flashing_widgets}
 
     def show_countdown(self, seconds, callback):
-        self.countdown_value = seconds
-        self.countdown_label.setText(f'{self.countdown_label_text}{self.countdown_value}')
-        self.countdown_timer = QTimer(self)
-        self.countdown_timer.timeout.connect(lambda: self.update_countdown(callback))
+        if self.countdown_label_text != self._count_prefix or seconds >= len(self._count_strings):
+            self._count_prefix = self.countdown_label_text
+            self._count_strings = [f'{self._count_prefix}{i}' for i in range(seconds + 1)]
+        self._countdown_cb = callback
+        self._countdown_value = seconds
+        self.countdown_label.setText(self._count_strings[seconds])
         self.countdown_timer.start(1000)
 
-    def update_countdown(self, callback):
-        self.countdown_value -= 1
-        if self.countdown_value <= 0:
+    def _on_countdown_tick(self):
+        self._countdown_value -= 1
+        if self._countdown_value <= 0:
             self.countdown_timer.stop()
             self.countdown_label.setText("")
-            callback()
+            self._countdown_cb()
         else:
-            self.countdown_label.setText(f'{self.countdown_label_text}{self.countdown_value}')
+            self.countdown_label.setText(self._count_strings[self._countdown_value])
 
-    def start_trial(self):
-        target_frequency = self.get_random_frequency()
-        
-        target_widget = None
-        for widget in self.flashing_widgets:
-            if widget.frequency == target_frequency:
-                target_widget = widget
-                break
+    def _trial_show_target(self):
+        target_frequency = self._trial_schedule[self.current_iteration]
         
-        self.set_state(State.TARGET, notes=f"target_frequency={target_frequency}_Hz")
-        target_widget.update_color(QColor("red"))
-        self.delay(self.config.target_display_duration * 1000)
-        target_widget.update_color(QColor(0,0,0,0))
+        self.set_state(State.TARGET, notes=f"target_frequency={target_frequency:g}_Hz")
+        self.target_widget = self._freq_to_widget[float(target_frequency)]
+        self.target_widget.update_color(Color.RED)
+        QTimer.singleShot(self.config.target_display_duration * 1000, self._trial_start_flash)
+
+    def _trial_start_flash(self):
+        self.target_widget.update_color(Color.CLEAR)
 
         self.set_state(State.FLASHING)
         self.flash_all_widgets()
-        self.delay(self.config.flashing_duration * 1000)
+        QTimer.singleShot(self.config.flashing_duration * 1000, self._trial_end_flash)
 
+    def _trial_end_flash(self):
+        self._stop_all_flashing()
         self.current_iteration += 1
         if self.current_iteration < self.config.num_sessions * self.config.num_classes:
             self.start_cooldown()
         else:
             self.stop_experiment(notes='Finished Experiment')
 
-
     def start_cooldown(self):
         self.set_state(State.COOLDOWN)
         self.countdown_label_text = f'Progress: {self.get_progress(self.current_iteration)}\nCooldown: '
-        def callback():
-            self.countdown_label_text = f'Progress: {self.get_progress(self.current_iteration)}\nStarting In: '
-            self.shuffle_frequencies()
-            self.set_state(State.COUNTDOWN)
-            self.show_countdown(self.config.trial_start_countdown, self.start_trial)
+        self.show_countdown(self.config.trial_cooldown_duration, self._on_cooldown_finished)
 
-        self.show_countdown(self.config.trial_cooldown_duration, callback)
+    def _on_cooldown_finished(self):
+        self.countdown_label_text = f'Progress: {self.get_progress(self.current_iteration)}\nStarting In: '
+        self.shuffle_frequencies()
+        self.set_state(State.COUNTDOWN)
+        self.show_countdown(self.config.trial_start_countdown, self._trial_show_target)
 
     def flash_all_widgets(self):
-        for widget in self.flashing_widgets:
-            widget.start_flashing()
-        QTimer.singleShot(self.config.flashing_duration * 1000, lambda: [widget.stop_flashing() for widget in self.flashing_widgets])
+        columns = [self._freq_columns[float(widget.frequency)] for widget in self.flashing_widgets]
+        self.schedule = self._phase_table[:, columns]
+        self.frame_idx = 0
+        self.elapsed_timer.start()
+        self.master_timer.start(0)
+
+    def _tick(self):
+        # Frame i is due at i * frame period from the start of flashing; timing against these
+        # absolute deadlines keeps whole-millisecond timer rounding from accumulating into phase drift
+        now_us = self.elapsed_timer.nsecsElapsed() / 1000
+        due_us = self.frame_idx * self._frame_period_us
+        if now_us < due_us - 1000:
+            # Timers can wake up early; re-arm for the rest of the wait instead of drawing ahead of time
+            self.master_timer.start(int((due_us - now_us) // 1000))
+            return
+        # If we woke up late, skip the frames that were missed so the phase stays locked
+        self.frame_idx = max(self.frame_idx, int(now_us // self._frame_period_us))
+        if self.frame_idx >= len(self.schedule):
+            return
+
+        levels = self.schedule[self.frame_idx]
+        for i, widget in enumerate(self.flashing_widgets):
+            widget.update_color(levels[i])
+        self.frame_idx += 1
 
-    def delay(self, milliseconds):
-        loop = QEventLoop()
-        QTimer.singleShot(milliseconds, loop.quit)
-        loop.exec_()
+        next_due_us = self.frame_idx * self._frame_period_us
+        self.master_timer.start(max(0, int((next_due_us - self.elapsed_timer.nsecsElapsed() / 1000) // 1000)))
+
+    def _stop_all_flashing(self):
+        self.master_timer.stop()
+        for widget in self.flashing_widgets:
+            widget.stop_flashing()
 
     def stop_experiment(self, *args, notes: str = ""):
         if notes == "": notes = "Experiment Stopped"
@@ -369,6 +437,13 @@ class ExperimentWindow(QMainWindow):
         self.close()
         sys.exit()
 
+    def closeEvent(self, event):
+        # Runs for stop_experiment and the title-bar close button alike
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+        super().closeEvent(event)
+
     def set_state(self, new_state: State, notes=""):
         self.current_state = new_state
         self.log_state(notes)